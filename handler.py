@@ -3,20 +3,35 @@ Handler for Marker PDF worker.
 
 This module handles the requests for the marker-pdf RunPod worker.
 """
+import asyncio
 import base64
-import json
+import os
+import shutil
 import sys
 import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from urllib.parse import urlparse
 
-import filetype
+import orjson
+import requests
 import runpod
-from runpod.serverless.utils import download_files_from_urls, rp_cleanup, rp_debugger
-from runpod.serverless.utils.rp_validator import validate
+from requests.adapters import HTTPAdapter
+from runpod.serverless.utils import rp_cleanup
+from runpod.serverless.utils.rp_download import HEADERS as DOWNLOAD_HEADERS, extract_disposition_params
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.util.retry import Retry
+
+try:
+    # SIMD-accelerated drop-in replacement for the stdlib decoder
+    import pybase64 as b64
+except ImportError:
+    b64 = base64
 
 # Import predict module from current directory
-from predict import Predictor
+from predict import Predictor, env_flag
 
 # Input validation schema
 INPUT_VALIDATIONS = {
@@ -94,103 +109,397 @@ INPUT_VALIDATIONS = {
     }
 }
 
+
+def compile_schema(schema):
+    """
+    Compile a RunPod-style validation schema into a validator function.
+
+    The returned function mirrors runpod's validate(raw_input, schema), with
+    the same error messages and {"errors"}/{"validated_input"} return shape,
+    and additionally enforces "enum" rules. An explicit null on an optional
+    key means "use the default". The schema is only inspected once, here,
+    instead of on every request.
+    """
+    fields = tuple(
+        (
+            key,
+            rules['type'],
+            rules.get('required', False),
+            rules.get('default'),
+            frozenset(rules['enum']) if 'enum' in rules else None,
+        )
+        for key, rules in schema.items()
+    )
+    known_keys = frozenset(schema)
+
+    def validate_input(raw_input):
+        if not isinstance(raw_input, dict):
+            return {"errors": [f"Input should be an object, not {type(raw_input)}."]}
+
+        errors = [
+            f"Unexpected input. {key} is not a valid input option."
+            for key in raw_input if key not in known_keys
+        ]
+        validated_input = dict(raw_input)
+
+        for key, expected_type, required, default, allowed in fields:
+            value = raw_input.get(key)
+            if value is None:
+                if required:
+                    errors.append(f"{key} is a required input.")
+                else:
+                    validated_input[key] = default
+                continue
+
+            if expected_type is float and type(value) is int:
+                value = validated_input[key] = float(value)
+
+            if not isinstance(value, expected_type):
+                errors.append(f"{key} should be {expected_type} type, not {type(value)}.")
+            elif allowed is not None and value not in allowed:
+                errors.append(f"{key} should be one of {sorted(allowed)}, not {value!r}.")
+
+        if errors:
+            return {"errors": errors}
+        return {"validated_input": validated_input}
+
+    return validate_input
+
+
+INPUT_VALIDATOR = compile_schema(INPUT_VALIDATIONS)
+
+# Jobs a worker accepts at once; conversion is still serialized by MODEL.gpu_lock
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 4))
+
+# Include stack traces in error responses (set MARKER_DEBUG=1 to enable)
+DEBUG = env_flag("MARKER_DEBUG")
+
 # Load the model into memory to make running multiple predictions efficient
 MODEL = Predictor()
 MODEL.setup()
 
 
+# Base64 characters decoded per chunk; a multiple of 4 so every chunk decodes on its own
+BASE64_CHUNK_CHARS = 1024 * 1024
+
+# Base64 characters decoded up front to sniff the file type (~4KB of content)
+SNIFF_CHARS = 4096 // 3 * 4
+
+# URL downloads: read size, (connect, read) timeouts, and a pooled session that
+# retries connection errors and transient server errors with backoff. The
+# session is shared by up to MAX_CONCURRENCY download threads
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)
+DOWNLOAD_SESSION = requests.Session()
+DOWNLOAD_SESSION.headers.update(DOWNLOAD_HEADERS)
+DOWNLOAD_ADAPTER = HTTPAdapter(
+    pool_maxsize=max(MAX_CONCURRENCY, 10),
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504)),
+)
+DOWNLOAD_SESSION.mount("http://", DOWNLOAD_ADAPTER)
+DOWNLOAD_SESSION.mount("https://", DOWNLOAD_ADAPTER)
+
+# Errors a failed download can raise: requests wraps most of them, but errors
+# while streaming the body come straight from urllib3
+DOWNLOAD_ERRORS = (requests.RequestException, Urllib3HTTPError)
+
+# Characters a base64 payload may contain once whitespace is removed
+BASE64_ALPHABET = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+
+# Files up to this size are written to RAM-backed /dev/shm instead of disk
+SHM_MAX_BYTES = int(os.environ.get("SHM_MAX_BYTES", 8 * 1024 * 1024))
+SHM_DIR = "/dev/shm" if SHM_MAX_BYTES > 0 and os.path.ismount("/dev/shm") else None
+
+# Single background thread that removes job inputs after the response is built
+CLEANUP_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cleanup")
+
+
 def _extract_base64_payload(data: str) -> str:
     """Remove data URL prefixes from base64 strings if present."""
     if data.startswith("data:"):
-        try:
-            return data.split(",", 1)[1]
-        except IndexError:
-            return data
-    return data
+        _, separator, payload = data.partition(",")
+        payload = payload if separator else data
+    else:
+        payload = data
+
+    # Embedded whitespace would shift chunk boundaries off the 4-character grid
+    if any(char in payload for char in (" ", "\n", "\r", "\t")):
+        payload = "".join(payload.split())
+    return payload
+
+
+def _tempfile_dir(size_hint: int) -> str | None:
+    """Pick the directory for a tempfile of roughly size_hint bytes (None means the default)."""
+    if not SHM_DIR or size_hint > SHM_MAX_BYTES:
+        return None
+
+    # Docker's default /dev/shm is only 64MB, so leave headroom for marker and torch
+    try:
+        shm_stats = os.statvfs(SHM_DIR)
+    except OSError:
+        return None
+    if size_hint * 2 > shm_stats.f_bavail * shm_stats.f_frsize:
+        return None
+    return SHM_DIR
+
+
+def _validate_base64(payload: str) -> memoryview:
+    """
+    Reject payloads that are not well-formed base64 before any decoding starts.
+
+    Returns a memoryview over the ASCII-encoded payload so the type sniff and
+    the chunked decode slice one shared buffer instead of copying the string.
+    """
+    if len(payload) % 4:
+        raise ValueError("Invalid base64 file payload: length is not a multiple of 4")
+    if not payload.isascii():
+        raise ValueError("Invalid base64 file payload: unexpected characters")
+
+    raw = payload.encode("ascii")
+    # translate() deletes every alphabet byte, so anything left over is invalid
+    if raw.translate(None, BASE64_ALPHABET):
+        raise ValueError("Invalid base64 file payload: unexpected characters")
+    return memoryview(raw)
+
+
+def _decode_base64(payload: memoryview) -> bytes:
+    """Decode a (4-character aligned) slice of a base64 payload."""
+    try:
+        return b64.b64decode(payload, validate=False)
+    except (base64.binascii.Error, ValueError) as decode_error:
+        raise ValueError("Invalid base64 file payload") from decode_error
+
+
+def _guess_suffix(payload: memoryview) -> str:
+    """Guess a file suffix from the decoded head of a base64 payload."""
+    # Imported lazily: only base64 uploads without a filename hint need it
+    from filetype import guess
+
+    guessed = guess(_decode_base64(payload[:SNIFF_CHARS]))
+    return f".{guessed.extension}" if guessed else ".pdf"
 
 
 def base64_to_tempfile(base64_file: str, filename_hint: str | None = None) -> str:
     '''
     Convert base64 file to tempfile.
 
+    The payload is decoded in chunks straight into the tempfile so the full
+    decoded document is never held in memory.
+
     Parameters:
     base64_file (str): Base64 file
 
     Returns:
     str: Path to tempfile
     '''
-    payload = _extract_base64_payload(base64_file)
+    payload = _validate_base64(_extract_base64_payload(base64_file))
 
-    try:
-        file_bytes = base64.b64decode(payload, validate=False)
-    except (base64.binascii.Error, ValueError) as decode_error:
-        raise ValueError("Invalid base64 file payload") from decode_error
+    suffix = Path(filename_hint).suffix if filename_hint else ""
+    if not suffix:
+        suffix = _guess_suffix(payload)
 
-    suffix = None
+    temp_dir = _tempfile_dir(len(payload) * 3 // 4)
 
-    if filename_hint:
-        suffix = Path(filename_hint).suffix
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False, dir=temp_dir) as temp_file:
+        try:
+            for start in range(0, len(payload), BASE64_CHUNK_CHARS):
+                temp_file.write(_decode_base64(payload[start:start + BASE64_CHUNK_CHARS]))
+        except ValueError:
+            temp_file.close()
+            Path(temp_file.name).unlink(missing_ok=True)
+            raise
 
-    if not suffix:
-        guessed = filetype.guess(file_bytes)
-        if guessed:
-            suffix = f".{guessed.extension}"
+    return temp_file.name
 
-    if not suffix:
-        suffix = ".pdf"
 
-    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
-        temp_file.write(file_bytes)
+def download_to_tempfile(url: str) -> str:
+    '''
+    Download a document to a tempfile.
+
+    The response body is copied straight into the tempfile in 1MB reads,
+    which lands in /dev/shm when Content-Length says the file fits there.
+
+    Parameters:
+    url (str): Document URL
+
+    Returns:
+    str: Path to tempfile
+    '''
+    with DOWNLOAD_SESSION.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+
+        # Prefer the server's filename, falling back to the URL path
+        suffix = ""
+        content_disposition = response.headers.get("Content-Disposition")
+        if content_disposition:
+            suffix = Path(extract_disposition_params(content_disposition).get("filename", "")).suffix
+        if not suffix:
+            suffix = Path(urlparse(url).path).suffix
+
+        # A compressed body's Content-Length says nothing about its size on disk
+        size_hint = int(response.headers.get("Content-Length") or 0)
+        if response.headers.get("Content-Encoding") or not size_hint:
+            temp_dir = None
+        else:
+            temp_dir = _tempfile_dir(size_hint)
+
+        response.raw.decode_content = True
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False, dir=temp_dir) as temp_file:
+            try:
+                shutil.copyfileobj(response.raw, temp_file, DOWNLOAD_CHUNK_BYTES)
+            except BaseException:
+                temp_file.close()
+                Path(temp_file.name).unlink(missing_ok=True)
+                raise
 
     return temp_file.name
 
 
-def truncate_long_string(s, max_length=1000000):
+def _prefetch_file(file_path: str) -> None:
+    """Ask the kernel to start reading a file into the page cache ahead of marker."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _cleanup_inputs(file_path: str) -> None:
+    """Remove a job's input file and runpod's input_objects directory."""
+    Path(file_path).unlink(missing_ok=True)
+    rp_cleanup.clean(['input_objects'])
+
+
+def _log_cleanup_failure(future) -> None:
+    """Done-callback for _cleanup_inputs; nothing else awaits its future."""
+    error = future.exception()
+    if error is not None:
+        print(f"Warning: Input cleanup failed: {error!r}", file=sys.stderr)
+
+
+# Longest string returned in a response, and the marker appended when one is cut
+MAX_STRING_LENGTH = 1000000
+TRUNCATION_SUFFIX = "... [truncated due to length]"
+
+# Types that serialize to JSON as-is
+JSON_SCALAR_TYPES = (int, float, bool, type(None))
+
+
+def truncate_long_string(s, max_length=MAX_STRING_LENGTH):
     """Truncate string if it's too long to prevent large responses."""
     if isinstance(s, str) and len(s) > max_length:
-        return s[:max_length] + "... [truncated due to length]"
+        return s[:max_length] + TRUNCATION_SUFFIX
     return s
 
 
-def sanitize_response(data, max_image_count=5):
+def sanitize_response(data, max_image_count=5, max_length=MAX_STRING_LENGTH):
     """
-    Recursively sanitize the response to ensure it can be properly serialized.
+    Sanitize the response in place to ensure it can be properly serialized.
     - Truncate long strings
     - Limit number of images
     - Convert non-serializable objects to strings
+
+    Containers are walked with an explicit stack rather than recursion, and
+    only values that need changing are rebound.
     """
-    if isinstance(data, dict):
-        sanitized = {}
-        # Limit the number of images
-        if "images" in data and isinstance(data["images"], list) and len(data["images"]) > max_image_count:
-            data["images"] = data["images"][:max_image_count]
-            data["images_note"] = f"Only showing {max_image_count} images out of {len(data['images'])} due to size limits"
-        
-        # Process each key-value pair
-        for key, value in data.items():
-            sanitized[key] = sanitize_response(value)
-        return sanitized
-    elif isinstance(data, list):
-        return [sanitize_response(item) for item in data]
-    elif isinstance(data, str):
-        return truncate_long_string(data)
-    elif isinstance(data, (int, float, bool, type(None))):
-        return data
-    else:
-        # Convert any other types to string to ensure serializability
-        return str(data)
+    if type(data) is str:
+        return truncate_long_string(data, max_length)
+    if type(data) not in (dict, list):
+        return data if type(data) in JSON_SCALAR_TYPES else str(data)
+
+    stack = [data]
+    while stack:
+        container = stack.pop()
+
+        if type(container) is dict:
+            # Limit the number of images
+            images = container.get("images")
+            if type(images) is list and len(images) > max_image_count:
+                container["images"] = images[:max_image_count]
+                container["images_note"] = f"Only showing {max_image_count} images out of {len(images)} due to size limits"
+            items = container.items()
+        else:
+            items = enumerate(container)
+
+        for key, value in items:
+            value_type = type(value)
+            if value_type is dict or value_type is list:
+                stack.append(value)
+            elif value_type is str:
+                # Short strings are left untouched: no call, no slice
+                if len(value) > max_length:
+                    container[key] = value[:max_length] + TRUNCATION_SUFFIX
+            elif value_type not in JSON_SCALAR_TYPES:
+                # Convert any other types to string to ensure serializability
+                container[key] = str(value)
 
+    return data
+
+
+def sanitize_document_response(results, text_key, max_image_count=5, max_length=MAX_STRING_LENGTH):
+    """
+    Fast path of sanitize_response for markdown and html results.
+
+    Those results hold one large text string, a metadata dict, a few scalars
+    and the image list, so only metadata and images need the generic walk.
+    """
+    text = results.get(text_key)
+    if type(text) is str and len(text) > max_length:
+        results[text_key] = text[:max_length] + TRUNCATION_SUFFIX
+
+    images = results.get("images")
+    if type(images) is list:
+        if len(images) > max_image_count:
+            results["images"] = images[:max_image_count]
+            results["images_note"] = f"Only showing {max_image_count} images out of {len(images)} due to size limits"
+        sanitize_response(results["images"], max_image_count, max_length)
+
+    if "metadata" in results:
+        results["metadata"] = sanitize_response(results["metadata"], max_image_count, max_length)
+
+    return results
+
+
+@contextmanager
+def _timed(timings: dict, step: str):
+    """
+    Record how long a handler step took, in seconds, under timings[step].
 
-def handler(event):
+    runpod's rp_debugger.LineTimer keeps checkpoints in a process-wide
+    registry keyed by step name, so it fails as soon as two jobs run at once.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = time.perf_counter() - start
+
+
+async def handler(event):
     """
     Process a single RunPod event payload.
+
+    Blocking work runs in worker threads so that, with several jobs in
+    flight, downloads and decoding overlap with another job's inference;
+    the GPU itself is only used by one job at a time.
     """
     try:
-        input_data = event['input']
+        input_data = event.get('input')
         start_time = time.time()
+        timings = {}
 
-        with rp_debugger.LineTimer('validation_step'):
-            input_validation = validate(input_data, INPUT_VALIDATIONS)
+        with _timed(timings, 'validation_step'):
+            input_validation = INPUT_VALIDATOR(input_data)
 
             if 'errors' in input_validation:
                 return {"error": input_validation['errors']}
@@ -208,39 +517,53 @@ def handler(event):
         filename_hint = input_data.get('filename')
 
         if file_url:
-            with rp_debugger.LineTimer('download_step'):
-                file_input = download_files_from_urls(event['id'], [file_url])[0]
+            with _timed(timings, 'download_step'):
+                try:
+                    file_input = await asyncio.to_thread(download_to_tempfile, file_url)
+                except DOWNLOAD_ERRORS as download_error:
+                    return {'error': f'Failed to download {file_url}: {download_error}'}
+
+            _prefetch_file(file_input)
         else:
-            file_input = base64_to_tempfile(file_base64, filename_hint=filename_hint)
-
-        with rp_debugger.LineTimer('prediction_step'):
-            results = MODEL.predict(
-                file_path=file_input,
-                output_format=input_data["output_format"],
-                paginate_output=input_data["paginate_output"],
-                use_llm=input_data["use_llm"],
-                disable_image_extraction=input_data["disable_image_extraction"],
-                page_range=input_data["page_range"],
-                force_ocr=input_data["force_ocr"],
-                strip_existing_ocr=input_data["strip_existing_ocr"],
-                languages=input_data["languages"],
-                model=input_data["model"]
-            )
-
-        with rp_debugger.LineTimer('cleanup_step'):
-            rp_cleanup.clean(['input_objects'])
+            file_input = await asyncio.to_thread(base64_to_tempfile, file_base64, filename_hint=filename_hint)
+
+        try:
+            with _timed(timings, 'prediction_step'):
+                results = await asyncio.to_thread(
+                    MODEL.predict,
+                    file_path=file_input,
+                    output_format=input_data["output_format"],
+                    paginate_output=input_data["paginate_output"],
+                    use_llm=input_data["use_llm"],
+                    disable_image_extraction=input_data["disable_image_extraction"],
+                    page_range=input_data["page_range"],
+                    force_ocr=input_data["force_ocr"],
+                    strip_existing_ocr=input_data["strip_existing_ocr"],
+                    languages=input_data["languages"],
+                    model=input_data["model"]
+                )
+        finally:
+            # Inputs are ours to remove; /dev/shm would otherwise fill up
+            # across warm invocations. Nothing reads them after predict, so
+            # the caller doesn't wait on it.
+            CLEANUP_EXECUTOR.submit(_cleanup_inputs, file_input).add_done_callback(_log_cleanup_failure)
 
         # Add processing time info
         processing_time = time.time() - start_time
         results["processing_time"] = processing_time
+        results["timings"] = timings
         
         # Sanitize the results to ensure they can be serialized properly
-        sanitized_results = sanitize_response(results)
+        if input_data["output_format"] in ("markdown", "html"):
+            sanitized_results = sanitize_document_response(results, input_data["output_format"])
+        else:
+            sanitized_results = sanitize_response(results)
         
-        # Test if results can be properly serialized
+        # Test if results can be properly serialized; RunPod serializes the
+        # returned dict again, so the probe uses orjson to keep it cheap
         try:
-            json.dumps(sanitized_results)
-        except (TypeError, OverflowError) as e:
+            orjson.dumps(sanitized_results, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError as e:
             print(f"Warning: Serialization error detected: {str(e)}", file=sys.stderr)
             # If serialization fails, return a simplified error message
             return {
@@ -254,23 +577,31 @@ def handler(event):
         import traceback
         error_message = str(e)
         stack_trace = traceback.format_exc()
+        # Worker logs always get the stack trace; responses only in debug mode
         print(f"Error in handler: {error_message}\n{stack_trace}", file=sys.stderr)
+        if not DEBUG:
+            return {"error": error_message}
         return {"error": error_message, "details": stack_trace}
 
 
+def concurrency_modifier(current_concurrency):
+    """Tell RunPod how many jobs this worker may run concurrently."""
+    return MAX_CONCURRENCY
+
+
 if __name__ == "__main__" and "--test" in sys.argv:
     test_file = Path("test_input.json")
     if not test_file.exists():
         print("test_input.json not found", file=sys.stderr)
         sys.exit(1)
 
-    payload = json.loads(test_file.read_text())
+    payload = orjson.loads(test_file.read_bytes())
     if "input" not in payload:
         payload = {"input": payload}
     payload.setdefault("id", "local-test")
 
-    result = handler(payload)
-    print(json.dumps(result, indent=2))
+    result = asyncio.run(handler(payload))
+    print(orjson.dumps(result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode())
     sys.exit(0)
 
-runpod.serverless.start({"handler": handler})
+runpod.serverless.start({"handler": handler, "concurrency_modifier": concurrency_modifier})
@@ -3,17 +3,59 @@ Prediction utilities for converting documents to structured outputs using marker
 """
 
 import base64
-import json
+import os
 import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageDraw
 
 from marker.converters.pdf import PdfConverter
 from marker.converters.table import TableConverter
 from marker.models import create_model_dict
 from runpod.serverless.utils import rp_cuda
-from marker.services.gemini import GoogleGeminiService
+
+try:
+    # SIMD-accelerated drop-in replacement for the stdlib encoder
+    import pybase64 as b64
+except ImportError:
+    b64 = base64
+
+# Values that turn a boolean environment variable on; anything else is off
+TRUTHY_VALUES = frozenset({"1", "true", "yes", "on"})
+
+
+def env_flag(name, default=False):
+    """Read a boolean environment variable, falling back to default when unset."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in TRUTHY_VALUES
+
+# Upper bound on threads used to optimize and encode extracted images
+IMAGE_WORKERS = min(8, os.cpu_count() or 1)
+
+# Source images larger than this are skipped rather than read into memory
+MAX_SOURCE_IMAGE_BYTES = int(os.environ.get("MAX_SOURCE_IMAGE_BYTES", 50 * 1024 * 1024))
+
+# Run one synthetic conversion at startup on GPU workers (set MARKER_WARMUP=0 to skip)
+WARMUP = env_flag("MARKER_WARMUP", default=True)
+
+# Extracted images optimized and returned per document
+MAX_IMAGES = 10
+
+# Image files with more pixels than this are skipped rather than decoded
+MAX_IMAGE_PIXELS = 40_000_000
+
+# LLM backend used when a request sets use_llm (reads GOOGLE_API_KEY from env)
+LLM_SERVICE = "marker.services.gemini.GoogleGeminiService"
+
+# Number of converter pipelines kept warm for reuse across requests
+CONVERTER_CACHE_SIZE = int(os.environ.get("CONVERTER_CACHE_SIZE", 8))
 
 
 class Predictor:
@@ -21,12 +63,53 @@ class Predictor:
 
     def __init__(self):
         self.model_artifacts = {}
+        self.device = "cpu"
+        self._image_executor = None
+        # Serializes GPU inference and converter cache access when the handler
+        # runs jobs concurrently. It is taken on the worker thread, so a
+        # cancelled request can't release it while its conversion still runs
+        self.gpu_lock = threading.Lock()
+        # Converters keyed by their configuration, least recently used first
+        self._converter_cache = OrderedDict()
 
     def setup(self):
         """Load the model into memory to make running multiple predictions efficient"""
         # Create model artifacts once
         self.model_artifacts = create_model_dict()
+        # The device cannot change during the process lifetime, so probe it once
+        self.device = "cuda" if rp_cuda.is_available() else "cpu"
+        # Threads for image optimization, shared by all requests
+        self._image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+        if self.device == "cuda" and WARMUP:
+            self._warmup()
+
+    def _warmup(self):
+        """
+        Convert a synthetic one-page PDF so the first real request doesn't pay
+        for CUDA kernel selection and allocator growth.
+
+        This also leaves the default converter in the converter cache.
+        """
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as warmup_file:
+            page = Image.new("RGB", (1275, 1650), "white")
+            ImageDraw.Draw(page).text((100, 100), "Warmup page for the marker worker.", fill="black")
+            page.save(warmup_file, format="PDF")
+
+        try:
+            self.predict(file_path=warmup_file.name)
+        except Exception as e:
+            print(f"Warning: Warmup conversion failed: {str(e)}", file=sys.stderr)
+        finally:
+            Path(warmup_file.name).unlink(missing_ok=True)
         
+    @staticmethod
+    def _encode_jpeg(img, quality):
+        """Encode a PIL image as an optimized progressive JPEG."""
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+        return buffer.getvalue()
+
     def _optimize_image(self, image_input, filename_hint="image.jpg", max_size=(1024, 1024), quality=85, max_file_size=1*1024*1024):
         """
         Optimize an image to reduce its file size before encoding to base64.
@@ -42,6 +125,7 @@ class Predictor:
             tuple: (Optimized image data as bytes, filename as str) or (None, filename_hint) on failure
         """
         img = None
+        opened_img = None # Image opened here from a path, closed before returning
         actual_filename = filename_hint
 
         try:
@@ -51,10 +135,31 @@ class Predictor:
             elif isinstance(image_input, (str, Path)):
                 image_path_obj = Path(image_input)
                 actual_filename = image_path_obj.name
-                if not image_path_obj.exists():
+                try:
+                    image_size = image_path_obj.stat().st_size
+                except FileNotFoundError:
                     print(f"Error: Image path {image_path_obj} does not exist.", file=sys.stderr)
                     return None, actual_filename
-                img = Image.open(image_path_obj)
+                if image_size > MAX_SOURCE_IMAGE_BYTES:
+                    print(f"Warning: Skipping image {image_path_obj}, larger than {MAX_SOURCE_IMAGE_BYTES} bytes.", file=sys.stderr)
+                    return None, actual_filename
+                img = opened_img = Image.open(image_path_obj)
+                # Image.open only parses the header, so these checks cost no decode
+                if img.width * img.height > MAX_IMAGE_PIXELS:
+                    print(f"Warning: Skipping image {image_path_obj}, larger than {MAX_IMAGE_PIXELS} pixels.", file=sys.stderr)
+                    return None, actual_filename
+                if (
+                    img.format == "JPEG"
+                    and image_size <= max_file_size
+                    and img.width <= max_size[0]
+                    and img.height <= max_size[1]
+                ):
+                    # Already small enough: return the original bytes untouched
+                    return image_path_obj.read_bytes(), actual_filename
+                if img.format == "JPEG":
+                    # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when the image
+                    # is much larger than max_size; thumbnail() does the final fit
+                    img.draft("RGB", max_size)
             else:
                 print(f"Error: Unsupported image input type {type(image_input)}.", file=sys.stderr)
                 return None, actual_filename
@@ -71,19 +176,23 @@ class Predictor:
             if img.width > max_size[0] or img.height > max_size[1]:
                 img.thumbnail(max_size, Image.LANCZOS)
             
-            # Save to memory buffer
-            buffer = BytesIO()
-            img.save(buffer, format="JPEG", quality=quality, optimize=True)
+            data = self._encode_jpeg(img, quality)
             
-            # If still too large, reduce quality until under max_file_size
-            data = buffer.getvalue()
-            current_quality = quality
-            
-            while len(data) > max_file_size and current_quality > 10:
-                current_quality -= 10
-                buffer = BytesIO()
-                img.save(buffer, format="JPEG", quality=current_quality, optimize=True)
-                data = buffer.getvalue()
+            # If still too large, binary-search the highest quality that fits
+            # under max_file_size (at most 7 re-encodes, falling back to quality 10)
+            if len(data) > max_file_size:
+                low, high = 10, quality - 1
+                best = None
+                while low <= high:
+                    current_quality = (low + high) // 2
+                    data = self._encode_jpeg(img, current_quality)
+                    if len(data) <= max_file_size:
+                        best = data
+                        low = current_quality + 1
+                    else:
+                        high = current_quality - 1
+                if best is not None:
+                    data = best
             
             return data, actual_filename
         except Exception as e:
@@ -97,7 +206,118 @@ class Predictor:
                 except Exception as e_read:
                     print(f"Error reading original image {actual_filename} during fallback: {str(e_read)}", file=sys.stderr)
             return None, actual_filename
+        finally:
+            # Release the file handle and decoded pixels right away rather than
+            # waiting for garbage collection
+            if opened_img is not None:
+                opened_img.close()
         
+    def _process_image(self, i, img_ref):
+        """
+        Optimize and base64-encode a single extracted image.
+
+        Returns:
+            dict: {"filename", "data"} for the image, or None if it could not be processed
+        """
+        optimized_img_data = None
+        img_filename = f"image_{i}.jpg" # Default/fallback filename
+
+        if isinstance(img_ref, (str, Path)):
+            # It's a path-like object; _optimize_image reports missing files
+            optimized_img_data, img_filename = self._optimize_image(Path(img_ref))
+        elif isinstance(img_ref, Image.Image): # It's a PIL Image object
+            optimized_img_data, img_filename = self._optimize_image(img_ref, filename_hint=f"embedded_image_{i}.jpg")
+        else:
+            print(f"Warning: img_ref is of unsupported type: {type(img_ref)}. Skipping image {i}.", file=sys.stderr)
+            return None
+
+        if not optimized_img_data:
+            return None
+
+        try:
+            return {
+                "filename": img_filename, # Use filename from _optimize_image
+                "data": b64.b64encode(optimized_img_data).decode("ascii")
+            }
+        except Exception as e:
+            print(f"Error encoding image {i} ({img_filename}): {str(e)}", file=sys.stderr)
+            return None
+
+    def _collect_images(self, rendered, disable_image_extraction, max_images_to_process=MAX_IMAGES):
+        """
+        Optimize and encode the images extracted by marker.
+
+        Returns:
+            dict: "images", "images_truncated" and "total_images" entries to merge into the results
+        """
+        images = getattr(rendered, 'images', None)
+        if disable_image_extraction or not images:
+            return {}
+
+        if isinstance(images, (dict, list)):
+            total_images = len(images)
+            # Only the references that will be processed are materialized
+            image_refs = list(islice(images.values() if isinstance(images, dict) else images, max_images_to_process))
+        else:
+            print(f"Warning: rendered.images is of unexpected type: {type(images)}. Skipping image processing.", file=sys.stderr)
+            return {}
+
+        processed_images_list = [
+            image for image in self._image_executor.map(self._process_image, range(len(image_refs)), image_refs)
+            if image
+        ]
+
+        collected = {}
+        if processed_images_list:
+            collected["images"] = processed_images_list
+
+        if total_images > len(image_refs) and processed_images_list:
+            collected["images_truncated"] = True
+            collected["total_images"] = total_images
+        elif not processed_images_list: # Had images, but none were processed
+            collected["total_images"] = total_images
+
+        return collected
+
+    def _get_converter(self, converter_class, converter_config, use_llm):
+        """
+        Return a converter for the given configuration, reusing a cached one when possible.
+
+        Marker converters hold no per-document state between calls, so the
+        processor pipeline built for one request can serve later requests
+        with the same configuration.
+        """
+        cache_key = (
+            converter_class,
+            use_llm,
+            tuple(sorted(
+                (key, tuple(value) if isinstance(value, list) else value)
+                for key, value in converter_config.items()
+            )),
+        )
+
+        converter = self._converter_cache.get(cache_key)
+        if converter is not None:
+            self._converter_cache.move_to_end(cache_key)
+            return converter
+
+        # Create the converter instance. marker builds the LLM service itself
+        # from a dotted class path, so it lives as long as the cached converter
+        # instead of being re-created per request. marker also stores the
+        # service in the artifact dict, so each converter gets its own shallow copy
+        converter = converter_class(
+            artifact_dict=dict(self.model_artifacts),
+            llm_service=LLM_SERVICE if use_llm else None,
+            config=converter_config # Pass the config dictionary here
+        )
+
+        if CONVERTER_CACHE_SIZE > 0:
+            self._converter_cache[cache_key] = converter
+            if len(self._converter_cache) > CONVERTER_CACHE_SIZE:
+                self._converter_cache.popitem(last=False)
+
+        return converter
+
     def predict(
         self,
         file_path,
@@ -114,20 +334,15 @@ class Predictor:
         """
         Run a single prediction on the model
         """
-        # Instantiate LLM service if use_llm is true
-        llm_service_instance = None
-        if use_llm:
-            try:
-                # Assuming GoogleGeminiService reads GOOGLE_API_KEY from env
-                llm_service_instance = GoogleGeminiService()
-            except ImportError:
-                print("Warning: GoogleGeminiService could not be imported. LLM features might be unavailable.", file=sys.stderr)
-            except Exception as e:
-                print(f"Warning: Could not instantiate GoogleGeminiService: {e}. LLM features might be unavailable.", file=sys.stderr)
+        # JSON output never returns images, so don't have marker extract them
+        if output_format == "json":
+            disable_image_extraction = True
 
         # Prepare the configuration dictionary for the converter constructor
         converter_config = {
             "disable_image_extraction": disable_image_extraction,
+            # marker's renderers only read extract_images
+            "extract_images": not disable_image_extraction,
             "force_ocr": force_ocr,
             "strip_existing_ocr": strip_existing_ocr,
         }
@@ -137,6 +352,9 @@ class Predictor:
             
         if languages:
             converter_config["languages"] = languages.split(",")
+
+        if use_llm:
+            converter_config["use_llm"] = True
             
         # Determine converter class and update config if model is "table"
         if model == "table":
@@ -145,18 +363,13 @@ class Predictor:
         else:
             converter_class = PdfConverter
         
-        # Set device type
-        device = "cuda" if rp_cuda.is_available() else "cpu"
-        
-        # Create the converter instance
-        converter = converter_class(
-            artifact_dict=self.model_artifacts,
-            llm_service=llm_service_instance,
-            config=converter_config # Pass the config dictionary here
-        )
-        
-        # Convert the document - __call__ method should only take the path
-        rendered = converter(str(file_path))
+        # Only the conversion holds the lock; image post-processing below
+        # overlaps with the next job's inference
+        with self.gpu_lock:
+            converter = self._get_converter(converter_class, converter_config, use_llm)
+
+            # Convert the document - __call__ method should only take the path
+            rendered = converter(str(file_path))
         
         # Process results based on output format
         results = {}
@@ -165,132 +378,25 @@ class Predictor:
         if output_format == "markdown":
             results["markdown"] = rendered.markdown
             results["metadata"] = rendered.metadata
-            
-            # Process images if they were extracted
-            if not disable_image_extraction and hasattr(rendered, 'images') and rendered.images:
-                processed_images_list = [] # Use a new name for clarity
-                
-                source_image_references = []
-                if isinstance(rendered.images, dict):
-                    source_image_references = list(rendered.images.values())
-                elif isinstance(rendered.images, list):
-                    source_image_references = rendered.images
-                else:
-                    print(f"Warning: rendered.images is of unexpected type: {type(rendered.images)}. Skipping image processing.", file=sys.stderr)
-
-                if source_image_references:
-                    max_images_to_process = min(10, len(source_image_references))
-                    
-                    for i, img_ref in enumerate(source_image_references[:max_images_to_process]):
-                        optimized_img_data = None
-                        img_filename = f"image_{i}.jpg" # Default/fallback filename
-
-                        if isinstance(img_ref, (str, Path)):
-                            # It's a path-like object
-                            image_path_obj = Path(img_ref)
-                            if image_path_obj.exists():
-                                optimized_img_data, img_filename = self._optimize_image(image_path_obj)
-                            else:
-                                print(f"Warning: Image path does not exist {image_path_obj}", file=sys.stderr)
-                        elif isinstance(img_ref, Image.Image): # It's a PIL Image object
-                            optimized_img_data, img_filename = self._optimize_image(img_ref, filename_hint=f"embedded_image_{i}.jpg")
-                        else:
-                            print(f"Warning: img_ref is of unsupported type: {type(img_ref)}. Skipping image {i}.", file=sys.stderr)
-                            continue # Skip to next image processing
-
-                        if optimized_img_data:
-                            try:
-                                # Optimize and encode the image
-                                img_data = base64.b64encode(optimized_img_data).decode("utf-8")
-                                processed_images_list.append({
-                                    "filename": img_filename, # Use filename from _optimize_image
-                                    "data": img_data
-                                })
-                            except Exception as e:
-                                print(f"Error encoding image {i} ({img_filename}): {str(e)}", file=sys.stderr)
-                        # else: # Optional: log if optimization returned None
-                        #     print(f"Warning: Optimization failed for image {i} ({img_filename if img_filename else img_ref})", file=sys.stderr)
-                
-                    if processed_images_list:
-                        results["images"] = processed_images_list
-
-                    if len(source_image_references) > max_images_to_process and processed_images_list:
-                        results["images_truncated"] = True
-                        results["total_images"] = len(source_image_references)
-                    elif len(source_image_references) > 0 and not processed_images_list : # Had images, but none were processed
-                        results["total_images"] = len(source_image_references)
+            results.update(self._collect_images(rendered, disable_image_extraction))
 
         elif output_format == "json":
-            # For JSON output, we need to convert the pydantic model to dict
-            json_data = rendered.json()
-            parsed_data = json.loads(json_data)
-            
-            # For JSON output, don't include the images to keep the response size manageable
-            if 'images' in parsed_data:
-                del parsed_data['images']
+            # Dump the pydantic model straight to JSON-compatible Python objects
+            # rather than round-tripping it through a JSON string. The converter
+            # renders MarkdownOutput, whose images never belong in JSON output
+            parsed_data = rendered.model_dump(mode="json", exclude={"images"})
+            if not isinstance(parsed_data, dict):
+                parsed_data = {"data": parsed_data}
             
             results = parsed_data
             
         elif output_format == "html":
             results["html"] = rendered.html
             results["metadata"] = rendered.metadata
-            
-            # Process images if they were extracted
-            if not disable_image_extraction and hasattr(rendered, 'images') and rendered.images:
-                processed_images_list = [] # Use a new name for clarity
-                
-                source_image_references = []
-                if isinstance(rendered.images, dict):
-                    source_image_references = list(rendered.images.values())
-                elif isinstance(rendered.images, list):
-                    source_image_references = rendered.images
-                else:
-                    print(f"Warning: rendered.images is of unexpected type: {type(rendered.images)}. Skipping image processing.", file=sys.stderr)
-
-                if source_image_references:
-                    max_images_to_process = min(10, len(source_image_references))
-                    
-                    for i, img_ref in enumerate(source_image_references[:max_images_to_process]):
-                        optimized_img_data = None
-                        img_filename = f"image_{i}.jpg" # Default/fallback filename
-
-                        if isinstance(img_ref, (str, Path)):
-                            # It's a path-like object
-                            image_path_obj = Path(img_ref)
-                            if image_path_obj.exists():
-                                optimized_img_data, img_filename = self._optimize_image(image_path_obj)
-                            else:
-                                print(f"Warning: Image path does not exist {image_path_obj}", file=sys.stderr)
-                        elif isinstance(img_ref, Image.Image): # It's a PIL Image object
-                            optimized_img_data, img_filename = self._optimize_image(img_ref, filename_hint=f"embedded_image_{i}.jpg")
-                        else:
-                            print(f"Warning: img_ref is of unsupported type: {type(img_ref)}. Skipping image {i}.", file=sys.stderr)
-                            continue # Skip to next image processing
-                        
-                        if optimized_img_data:
-                            try:
-                                # Optimize and encode the image
-                                img_data = base64.b64encode(optimized_img_data).decode("utf-8")
-                                processed_images_list.append({
-                                    "filename": img_filename, # Use filename from _optimize_image
-                                    "data": img_data
-                                })
-                            except Exception as e:
-                                print(f"Error encoding image {i} ({img_filename}): {str(e)}", file=sys.stderr)
-                        # else: # Optional: log if optimization returned None
-                        #     print(f"Warning: Optimization failed for image {i} ({img_filename if img_filename else img_ref})", file=sys.stderr)
-
-                    if processed_images_list:
-                        results["images"] = processed_images_list
-                        
-                    if len(source_image_references) > max_images_to_process and processed_images_list:
-                        results["images_truncated"] = True
-                        results["total_images"] = len(source_image_references)
-                    elif len(source_image_references) > 0 and not processed_images_list : # Had images, but none were processed
-                        results["total_images"] = len(source_image_references)
+            results.update(self._collect_images(rendered, disable_image_extraction))
         
         # Additional info
-        results["device"] = device
+        results["device"] = self.device
         results["model"] = model # 'model' is the original input parameter
             
         return results
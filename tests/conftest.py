@@ -0,0 +1,81 @@
+"""
+Shared fixtures for the worker tests.
+
+marker's converters load GPU models, so the tests swap in FakeConverter and
+exercise everything around the conversion itself.
+"""
+
+import importlib
+import sys
+import time
+import types
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+pydantic = pytest.importorskip("pydantic")
+pytest.importorskip("runpod")
+
+
+class MarkdownOutput(pydantic.BaseModel):
+    """Same fields as marker.renderers.markdown.MarkdownOutput."""
+    markdown: str
+    images: dict
+    metadata: dict
+
+
+class FakeConverter:
+    """Stands in for PdfConverter/TableConverter; renders the input file's text."""
+
+    delay = 0.0
+
+    def __init__(self, artifact_dict, processor_list=None, renderer=None, llm_service=None, config=None):
+        self.config = config
+
+    def __call__(self, file_path):
+        time.sleep(self.delay)
+        return MarkdownOutput(
+            markdown=Path(file_path).read_text(),
+            images={},
+            metadata={"page_stats": []},
+        )
+
+
+def _fake_marker_modules():
+    modules = {
+        name: types.ModuleType(name)
+        for name in ("marker", "marker.converters", "marker.converters.pdf", "marker.converters.table", "marker.models")
+    }
+    modules["marker.converters.pdf"].PdfConverter = FakeConverter
+    modules["marker.converters.table"].TableConverter = FakeConverter
+    modules["marker.models"].create_model_dict = dict
+    return modules
+
+
+@pytest.fixture
+def fake_converter(monkeypatch):
+    """Reset FakeConverter's class-level knobs after each test."""
+    monkeypatch.setattr(FakeConverter, "delay", 0.0)
+    return FakeConverter
+
+
+@pytest.fixture
+def load_module(monkeypatch):
+    """Import a worker module fresh, so module-level settings re-read the environment."""
+    import runpod
+
+    monkeypatch.setattr(runpod.serverless, "start", lambda config: None)
+    for name, module in _fake_marker_modules().items():
+        monkeypatch.setitem(sys.modules, name, module)
+
+    def load(name):
+        for module_name in ("handler", "predict"):
+            monkeypatch.delitem(sys.modules, module_name, raising=False)
+        return importlib.import_module(name)
+
+    yield load
+
+    for module_name in ("handler", "predict"):
+        sys.modules.pop(module_name, None)
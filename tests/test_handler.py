@@ -0,0 +1,58 @@
+import asyncio
+import base64
+
+import pytest
+
+
+def _event(job_id, text):
+    return {
+        "id": job_id,
+        "input": {"file_base64": base64.b64encode(text.encode()).decode(), "filename": "doc.txt"},
+    }
+
+
+def test_concurrent_jobs_do_not_share_step_timers(load_module, fake_converter):
+    handler = load_module("handler")
+    fake_converter.delay = 0.2
+
+    async def run_both():
+        return await asyncio.gather(
+            handler.handler(_event("job-1", "first")),
+            handler.handler(_event("job-2", "second")),
+        )
+
+    first, second = asyncio.run(run_both())
+
+    assert "error" not in first and "error" not in second
+    assert first["markdown"] == "first"
+    assert second["markdown"] == "second"
+    assert set(first["timings"]) == {"validation_step", "prediction_step"}
+
+
+@pytest.mark.parametrize("value", ["false", "", "0", "off", "no"])
+def test_debug_stays_off_for_falsy_values(load_module, monkeypatch, value):
+    monkeypatch.setenv("MARKER_DEBUG", value)
+
+    assert load_module("handler").DEBUG is False
+
+
+@pytest.mark.parametrize("value", ["1", "true", "YES", " on "])
+def test_debug_turns_on_for_truthy_values(load_module, monkeypatch, value):
+    monkeypatch.setenv("MARKER_DEBUG", value)
+
+    assert load_module("handler").DEBUG is True
+
+
+def test_cleanup_failures_are_logged(load_module, monkeypatch, capsys):
+    handler = load_module("handler")
+
+    def fail(paths):
+        raise PermissionError("input_objects is read-only")
+
+    monkeypatch.setattr(handler.rp_cleanup, "clean", fail)
+
+    result = asyncio.run(handler.handler(_event("job-1", "text")))
+    handler.CLEANUP_EXECUTOR.submit(lambda: None).result()
+
+    assert result["markdown"] == "text"
+    assert "Input cleanup failed: PermissionError('input_objects is read-only')" in capsys.readouterr().err
@@ -0,0 +1,11 @@
+def test_json_output_has_no_images(load_module, fake_converter, tmp_path):
+    predict = load_module("predict")
+    predictor = predict.Predictor()
+    predictor.setup()
+    document = tmp_path / "doc.txt"
+    document.write_text("hello")
+
+    results = predictor.predict(file_path=str(document), output_format="json")
+
+    assert "images" not in results
+    assert results["markdown"] == "hello"